@@ -1,18 +1,66 @@
+import asyncio
+import logging
 import os
 import time
-from fastapi import FastAPI, HTTPException
+from contextlib import asynccontextmanager
+from pathlib import Path
+import httpx
+from fastapi import Depends, FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import HTMLResponse
-from pydantic import BaseModel
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import HTMLResponse, JSONResponse, Response
+from pydantic import BaseModel, ConfigDict, Field, model_validator
 from dotenv import load_dotenv
-from typing import Optional
+from typing import Any, Dict, List, Optional, Tuple, Union
 
 from app.services.query_translator import QueryTranslator
+from app.services.singleflight import SingleFlightCache
 from app.services.tmdb_service import TMDBService
 
 load_dotenv()
 
-app = FastAPI(title="AI Movie Search Assistant")
+logger = logging.getLogger(__name__)
+
+# Fail fast on connect; bounds a stalled upstream to a few seconds per attempt
+DEFAULT_TIMEOUT = httpx.Timeout(8.0, connect=2.0)
+
+# Test page served at "/", read once at import
+_INDEX_HTML = (Path(__file__).parent / "static" / "index.html").read_bytes()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Shared HTTP client so outbound calls reuse pooled connections
+    # The transport retries failed connection attempts; status-level retries
+    # (429/5xx) are handled per call in app.services.retry
+    app.state.http = httpx.AsyncClient(
+        timeout=DEFAULT_TIMEOUT,
+        transport=httpx.AsyncHTTPTransport(
+            http2=True,
+            retries=2,
+            limits=httpx.Limits(max_connections=100, max_keepalive_connections=20),
+        ),
+    )
+    
+    # Services are stateless apart from keys and the client, so build them once
+    openrouter_api_key = os.getenv("OPENROUTER_API_KEY")
+    tmdb_api_key = os.getenv("TMDB_API_KEY")
+    app.state.translator = QueryTranslator(openrouter_api_key, app.state.http) if openrouter_api_key else None
+    app.state.tmdb = TMDBService(tmdb_api_key, app.state.http) if tmdb_api_key else None
+    
+    if app.state.tmdb:
+        await app.state.tmdb.warm_genre_cache()
+    
+    # Full search results keyed on normalized query; concurrent identical
+    # searches share one pipeline run
+    app.state.search_cache = SingleFlightCache(maxsize=512, ttl=3600)
+    try:
+        yield
+    finally:
+        if app.state.tmdb:
+            await app.state.tmdb.close()
+        await app.state.http.aclose()
+
+app = FastAPI(title="AI Movie Search Assistant", lifespan=lifespan)
 
 # Get allowed origins from environment or use defaults
 allowed_origins = os.getenv("ALLOWED_ORIGINS", "").split(",") if os.getenv("ALLOWED_ORIGINS") else [
@@ -33,224 +81,138 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Compress the test page and search results (20 movies is well over the threshold)
+app.add_middleware(GZipMiddleware, minimum_size=500)
+
 class SearchQuery(BaseModel):
-    query: str
+    query: Optional[str] = None
+    # Several searches in one call, run concurrently; response is then a list
+    queries: Optional[List[str]] = Field(default=None, max_length=10)
+    
+    @model_validator(mode="after")
+    def check_has_query(self) -> "SearchQuery":
+        if self.query is None and not self.queries:
+            raise ValueError("Either 'query' or 'queries' must be provided")
+        return self
+
+class MovieOut(BaseModel):
+    model_config = ConfigDict(extra="ignore")
+    
+    id: int
+    title: str
+    original_title: Optional[str] = None
+    overview: Optional[str] = None
+    release_date: Optional[str] = None
+    vote_average: float = 0
+    vote_count: int = 0
+    popularity: float = 0
+    poster_path: Optional[str] = None
+    backdrop_path: Optional[str] = None
+    genre_ids: List[int] = []
+    genre_names: List[str] = []
+    adult: bool = False
+    original_language: Optional[str] = None
+    poster_url: Optional[str] = None
+    backdrop_url: Optional[str] = None
+
+class SearchResponse(BaseModel):
+    search_params: Dict[str, Any]
+    movies: List[MovieOut]
+    total_count: int
+    response_time_ms: int
+
+def get_translator(request: Request) -> QueryTranslator:
+    translator = request.app.state.translator
+    if translator is None:
+        raise HTTPException(status_code=500, detail="OpenRouter API key not configured")
+    return translator
+
+def get_tmdb(request: Request) -> TMDBService:
+    tmdb = request.app.state.tmdb
+    if tmdb is None:
+        raise HTTPException(status_code=500, detail="TMDB API key not configured")
+    return tmdb
 
 @app.get("/", response_class=HTMLResponse)
-async def root():
-    return """
-    <!DOCTYPE html>
-    <html>
-    <head>
-        <title>AI Movie Search Assistant</title>
-        <style>
-            body {
-                font-family: Arial, sans-serif;
-                max-width: 800px;
-                margin: 0 auto;
-                padding: 20px;
-            }
-            .container {
-                display: flex;
-                flex-direction: column;
-                gap: 20px;
-            }
-            textarea {
-                width: 100%;
-                height: 100px;
-                padding: 10px;
-                border-radius: 5px;
-                border: 1px solid #ddd;
-            }
-            button {
-                background-color: #007bff;
-                color: white;
-                padding: 10px 20px;
-                border: none;
-                border-radius: 5px;
-                cursor: pointer;
-            }
-            button:hover {
-                background-color: #0056b3;
-            }
-            .result {
-                background-color: #f8f9fa;
-                border: 1px solid #e9ecef;
-                border-radius: 5px;
-                padding: 15px;
-                margin-top: 10px;
-            }
-            .movie {
-                border-bottom: 1px solid #e9ecef;
-                padding-bottom: 10px;
-                margin-bottom: 10px;
-                display: flex;
-                gap: 15px;
-            }
-            .movie:last-child {
-                border-bottom: none;
-                margin-bottom: 0;
-            }
-            .movie-poster {
-                width: 60px;
-                height: 90px;
-                object-fit: cover;
-                border-radius: 5px;
-            }
-            .movie-info {
-                flex: 1;
-            }
-            .movie-title {
-                font-weight: bold;
-                color: #007bff;
-                margin-bottom: 5px;
-            }
-            .movie-meta {
-                color: #666;
-                font-size: 14px;
-                margin-bottom: 5px;
-            }
-            .movie-overview {
-                color: #333;
-                font-size: 14px;
-                line-height: 1.4;
-            }
-        </style>
-    </head>
-    <body>
-        <div class="container">
-            <h1>🎬 AI Movie Search Assistant</h1>
-            
-            <div>
-                <label for="searchQuery">What movies would you like to find?</label>
-                <textarea 
-                    id="searchQuery" 
-                    placeholder="e.g., Action movies from the 90s with high ratings, or Sci-fi films with time travel"
-                ></textarea>
-                <button onclick="searchMovies()">🔍 Search Movies</button>
-            </div>
-            
-            <div id="result"></div>
-        </div>
+async def root(request: Request):
+    # API clients (curl, SDKs) get a short route listing instead of the test page
+    if "text/html" not in request.headers.get("accept", ""):
+        return JSONResponse(
+            {
+                "message": "AI Movie Search Assistant API",
+                "routes": {
+                    "search": "POST /api/search",
+                    "health": "GET /api/health",
+                },
+            },
+            headers={"Vary": "Accept"},
+        )
+    
+    return Response(
+        content=_INDEX_HTML,
+        media_type="text/html",
+        headers={"Cache-Control": "public, max-age=3600", "Vary": "Accept"},
+    )
 
-        <script>
-            async function searchMovies() {
-                const query = document.getElementById('searchQuery').value;
-                const resultDiv = document.getElementById('result');
-                
-                if (!query.trim()) {
-                    alert('Please enter a search query');
-                    return;
-                }
-                
-                resultDiv.innerHTML = '<p>🔍 Searching movies...</p>';
-                
-                try {
-                    const response = await fetch('/api/search', {
-                        method: 'POST',
-                        headers: {
-                            'Content-Type': 'application/json',
-                        },
-                        body: JSON.stringify({ query: query })
-                    });
-                    
-                    if (!response.ok) {
-                        throw new Error(`HTTP error! status: ${response.status}`);
-                    }
-                    
-                    const data = await response.json();
-                    displayResults(data);
-                } catch (error) {
-                    resultDiv.innerHTML = `<div class="result"><p>❌ Error: ${error.message}</p></div>`;
-                }
-            }
-            
-            function displayResults(data) {
-                const resultDiv = document.getElementById('result');
-                
-                if (!data.movies || data.movies.length === 0) {
-                    resultDiv.innerHTML = '<div class="result"><p>No movies found.</p></div>';
-                    return;
-                }
-                
-                let html = '<div class="result">';
-                html += `<h3>🔍 Search Type: <code>${data.search_params.search_type}</code></h3>`;
-                html += `<h4>📋 Parameters: <code>${JSON.stringify(data.search_params.params)}</code></h4>`;
-                html += `<p>Found ${data.movies.length} movies:</p>`;
-                
-                data.movies.forEach(movie => {
-                    const posterUrl = movie.poster_path ? 
-                        `https://image.tmdb.org/t/p/w92${movie.poster_path}` : 
-                        'https://via.placeholder.com/60x90?text=No+Image';
-                    
-                    html += `
-                        <div class="movie">
-                            <img src="${posterUrl}" alt="${movie.title}" class="movie-poster">
-                            <div class="movie-info">
-                                <div class="movie-title">${movie.title}</div>
-                                <div class="movie-meta">
-                                    ⭐ ${movie.vote_average}/10 | 
-                                    📅 ${movie.release_date || 'Unknown'} | 
-                                    🎭 ${movie.genre_names ? movie.genre_names.join(', ') : 'Unknown'}
-                                </div>
-                                <div class="movie-overview">${movie.overview || 'No description available'}</div>
-                            </div>
-                        </div>
-                    `;
-                });
-                
-                html += '</div>';
-                resultDiv.innerHTML = html;
-            }
-            
-            // Allow Enter key to trigger search
-            document.getElementById('searchQuery').addEventListener('keypress', function(event) {
-                if (event.key === 'Enter' && !event.shiftKey) {
-                    event.preventDefault();
-                    searchMovies();
-                }
-            });
-        </script>
-    </body>
-    </html>
+async def _run_search(natural_query: str, translator: QueryTranslator, tmdb: TMDBService) -> Tuple[Dict[str, Any], bool]:
     """
-
-@app.post("/api/search")
-async def search_movies(query: SearchQuery):
-    start_time = time.time()
+    Translate the query and fetch matching movies
+    Returns (result, complete); complete is False when the translation or a
+    TMDB lookup fell back to a degraded answer
+    """
+    # Translate natural language to TMDB search parameters
+    search_params = await translator.translate_query(natural_query)
     
-    # Get API keys from environment
-    openrouter_api_key = os.getenv("OPENROUTER_API_KEY")
-    tmdb_api_key = os.getenv("TMDB_API_KEY")
+    # Search movies using TMDB API
+    movies, complete = await tmdb.search_movies(search_params)
     
-    if not openrouter_api_key:
-        raise HTTPException(status_code=500, detail="OpenRouter API key not configured")
+    result = {
+        "search_params": search_params,
+        "movies": movies,
+        "total_count": len(movies),
+    }
+    return result, complete and translator.is_cached(natural_query)
+
+@app.post("/api/search", response_model=Union[SearchResponse, List[SearchResponse]])
+async def search_movies(
+    query: SearchQuery,
+    request: Request,
+    translator: QueryTranslator = Depends(get_translator),
+    tmdb: TMDBService = Depends(get_tmdb),
+):
+    start_time = time.perf_counter()
     
-    if not tmdb_api_key:
-        raise HTTPException(status_code=500, detail="TMDB API key not configured")
+    async def run_one(natural_query: str) -> SearchResponse:
+        key = natural_query.strip().lower()
+        # Results built on a degraded translation or TMDB lookup are not cached
+        result, _ = await request.app.state.search_cache.get_or_run(
+            key,
+            lambda: _run_search(natural_query, translator, tmdb),
+            cacheable=lambda outcome: outcome[1],
+        )
+        response_time_ms = int((time.perf_counter() - start_time) * 1000)
+        return SearchResponse(**result, response_time_ms=response_time_ms)
     
     try:
-        # Initialize services
-        translator = QueryTranslator(openrouter_api_key)
-        tmdb = TMDBService(tmdb_api_key)
-        
-        # Translate natural language to TMDB search parameters
-        search_params = await translator.translate_query(query.query)
-        
-        # Search movies using TMDB API
-        movies = await tmdb.search_movies(search_params)
-        
-        response_time_ms = int((time.time() - start_time) * 1000)
+        # Single query keeps the original response shape
+        if not query.queries:
+            return await run_one(query.query)
         
-        return {
-            "search_params": search_params,
-            "movies": movies,
-            "total_count": len(movies),
-            "response_time_ms": response_time_ms
-        }
+        natural_queries = ([query.query] if query.query is not None else []) + query.queries
+        return list(await asyncio.gather(*[run_one(q) for q in natural_queries]))
         
+    except httpx.HTTPStatusError as e:
+        logger.exception("Upstream API returned %s for search", e.response.status_code)
+        raise HTTPException(status_code=502, detail=f"Upstream API error: {e.response.status_code}")
+    except httpx.TimeoutException:
+        logger.exception("Upstream API timed out during search")
+        raise HTTPException(status_code=504, detail="Upstream API timed out")
+    except httpx.HTTPError as e:
+        logger.exception("Upstream API request failed during search")
+        raise HTTPException(status_code=502, detail=f"Upstream API request failed: {e}")
     except Exception as e:
-        response_time_ms = int((time.time() - start_time) * 1000)
+        # Still answer with an HTTPException so the response goes through CORS
+        logger.exception("Search failed")
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/api/health")
@@ -266,4 +228,7 @@ async def health_check():
 if __name__ == "__main__":
     import uvicorn
     port = int(os.getenv("PORT", 3000))
-    uvicorn.run(app, host="0.0.0.0", port=port) 
\ No newline at end of file
+    # Caches and the TMDB request limits live per process, so extra workers
+    # are opt-in through WEB_CONCURRENCY
+    workers = int(os.getenv("WEB_CONCURRENCY", 1))
+    uvicorn.run("app.main:app", host="0.0.0.0", port=port, workers=workers) 
\ No newline at end of file
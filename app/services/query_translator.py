@@ -1,11 +1,21 @@
 import httpx
-import json
-from typing import Dict, Any, Optional
+import logging
+import orjson
+from collections import OrderedDict
+from typing import Dict, Any, Tuple
 import re
 
+from app.services.retry import retrying
+
+logger = logging.getLogger(__name__)
+
+# Patterns used on every translation, compiled once at import
+_YEAR_RE = re.compile(r'\b(19|20)\d{2}\b')
+
 class QueryTranslator:
-    def __init__(self, openrouter_api_key: str):
+    def __init__(self, openrouter_api_key: str, client: httpx.AsyncClient):
         self.api_key = openrouter_api_key
+        self.client = client
         self.base_url = "https://openrouter.ai/api/v1/chat/completions"
         
         # Genre mapping: name -> TMDB ID
@@ -31,39 +41,77 @@ class QueryTranslator:
             "western": 37
         }
         
+        # Genre names plus their plurals ("thrillers", "comedies"), as
+        # users usually ask for genres in the plural
+        self._genre_aliases = dict(self.genre_map)
+        for name, genre_id in self.genre_map.items():
+            plural = name[:-1] + "ies" if name.endswith("y") else name + "s"
+            self._genre_aliases.setdefault(plural, genre_id)
+        
+        # Single alternation over all genre aliases, longest first so
+        # "science fiction" and plurals win over shorter overlapping names
+        self._genre_re = re.compile(
+            r'\b(' + '|'.join(re.escape(name) for name in sorted(self._genre_aliases, key=len, reverse=True)) + r')\b'
+        )
+        
+        # LRU cache of translated queries, keyed on the normalized query text
+        self._cache: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._cache_size = 1024
+        
     async def translate_query(self, natural_query: str) -> Dict[str, Any]:
         """
         Translate natural language query to TMDB discover/search parameters
         Returns dict with 'search_type' and 'params' keys
         """
+        key = natural_query.strip().lower()
+        cached = self._cache.get(key)
+        if cached is not None:
+            self._cache.move_to_end(key)
+            return cached
+        
+        result, cacheable = await self._translate(natural_query)
+        
+        # A fallback after an OpenRouter failure is not kept, so the next
+        # identical query tries the AI again
+        if cacheable:
+            self._cache[key] = result
+            self._cache.move_to_end(key)
+            if len(self._cache) > self._cache_size:
+                self._cache.popitem(last=False)
         
+        return result
+    
+    def is_cached(self, natural_query: str) -> bool:
+        """Whether the translation of natural_query is held in the cache"""
+        return natural_query.strip().lower() in self._cache
+    
+    async def _translate(self, natural_query: str) -> Tuple[Dict[str, Any], bool]:
+        """Translate without consulting the cache, returning (result, cacheable)"""
         # Check if API key is available
         if not self.api_key or self.api_key == "":
-            print("OpenRouter API key not set, using fallback rule-based translation")
-            return self._translate_with_rules(natural_query)
+            logger.info("OpenRouter API key not set, using fallback rule-based translation")
+            return self._translate_with_rules(natural_query), True
         
         # Try OpenRouter API first
         try:
-            return await self._translate_with_ai(natural_query)
+            return await self._translate_with_ai(natural_query), True
+        except httpx.HTTPStatusError as e:
+            logger.warning("OpenRouter API HTTP error: %s - %s", e.response.status_code, e.response.text)
         except Exception as e:
-            print(f"OpenRouter API failed, using fallback: {e}")
-            # Fallback to rule-based translation
-            return self._translate_with_rules(natural_query)
+            logger.warning("OpenRouter API failed, using fallback: %s", e)
+        # Degraded fallback to rule-based translation
+        return self._translate_with_rules(natural_query), False
     
     async def _translate_with_ai(self, natural_query: str) -> Dict[str, Any]:
-        """Use OpenRouter AI for translation"""
+        """Use OpenRouter AI for translation, raising if the call or its output fails"""
         system_prompt = """You are an expert at converting natural language movie search queries into TMDB (The Movie Database) API parameters.
 
-Your task is to analyze the user's natural language query and return search parameters in XML format.
+Your task is to analyze the user's natural language query and return search parameters as a JSON object.
 
-Use this XML structure:
-<search>
-    <type>discover</type> <!-- or "search" -->
-    <params>
-        <param name="parameter_name">value</param>
-        <!-- additional params as needed -->
-    </params>
-</search>
+Use this JSON structure:
+{"search_type": "discover", "params": {"parameter_name": "value"}}
+
+"search_type" is either "discover" or "search". All param values are strings.
 
 For "discover" type (use for genre, year, rating, actor filters):
 - with_genres: genre IDs (action=28, comedy=35, drama=18, horror=27, sci-fi=878, thriller=53, romance=10749, animation=16, crime=80, fantasy=14)
@@ -79,44 +127,18 @@ For "search" type (use for specific movie titles):
 Examples:
 
 Input: "action movies from 2020"
-Output:
-<search>
-    <type>discover</type>
-    <params>
-        <param name="with_genres">28</param>
-        <param name="primary_release_year">2020</param>
-    </params>
-</search>
+Output: {"search_type": "discover", "params": {"with_genres": "28", "primary_release_year": "2020"}}
 
 Input: "comedies with high ratings"
-Output:
-<search>
-    <type>discover</type>
-    <params>
-        <param name="with_genres">35</param>
-        <param name="vote_average.gte">7.5</param>
-    </params>
-</search>
+Output: {"search_type": "discover", "params": {"with_genres": "35", "vote_average.gte": "7.5"}}
 
 Input: "movies starring Tom Hanks"
-Output:
-<search>
-    <type>discover</type>
-    <params>
-        <param name="with_cast">Tom Hanks</param>
-    </params>
-</search>
+Output: {"search_type": "discover", "params": {"with_cast": "Tom Hanks"}}
 
 Input: "The Dark Knight"
-Output:
-<search>
-    <type>search</type>
-    <params>
-        <param name="query">The Dark Knight</param>
-    </params>
-</search>
+Output: {"search_type": "search", "params": {"query": "The Dark Knight"}}
 
-Return ONLY the XML, no other text or formatting."""
+Return ONLY the JSON object, no other text or formatting."""
 
         user_prompt = f"Convert this movie search query: {natural_query}"
         
@@ -133,46 +155,47 @@ Return ONLY the XML, no other text or formatting."""
                 {"role": "system", "content": system_prompt},
                 {"role": "user", "content": user_prompt}
             ],
-            "temperature": 0.3,
-            "max_tokens": 200
+            # Output is a short JSON object; deterministic sampling keeps it cacheable
+            "temperature": 0.0,
+            "max_tokens": 80,
+            "response_format": {"type": "json_object"}
         }
         
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            try:
-                response = await client.post(self.base_url, headers=headers, json=data)
+        async for attempt in retrying():
+            with attempt:
+                response = await self.client.post(self.base_url, headers=headers, json=data)
                 response.raise_for_status()
-                
-                result = response.json()
-                ai_response = result["choices"][0]["message"]["content"].strip()
-                
-                # Parse XML response
-                try:
-                    parsed_result = self._parse_xml_response(ai_response)
-                    return self._validate_and_process_params(parsed_result)
-                except Exception as e:
-                    print(f"AI returned unparseable response: {ai_response}")
-                    print(f"Parse error: {e}")
-                    return self._translate_with_rules(natural_query)
-                    
-            except httpx.HTTPStatusError as e:
-                print(f"OpenRouter API HTTP error: {e.response.status_code} - {e.response.text}")
-                return self._translate_with_rules(natural_query)
-            except Exception as e:
-                print(f"OpenRouter API error: {str(e)}")
-                return self._translate_with_rules(natural_query)
-    
-    def _parse_xml_response(self, xml_response: str) -> Dict[str, Any]:
-        """Parse XML response into structured parameters"""
-        # Extract search type
-        type_match = re.search(r'<type>(.*?)</type>', xml_response, re.DOTALL)
-        search_type = type_match.group(1).strip() if type_match else "search"
         
-        # Extract parameters
-        params = {}
-        param_matches = re.findall(r'<param name="([^"]+)">(.*?)</param>', xml_response, re.DOTALL)
+        result = orjson.loads(response.content)
+        ai_response = result["choices"][0]["message"]["content"].strip()
         
-        for param_name, param_value in param_matches:
-            params[param_name.strip()] = param_value.strip()
+        # Parse JSON response
+        try:
+            parsed_result = self._parse_json_response(ai_response)
+        except Exception:
+            logger.warning("AI returned unparseable response %r", ai_response)
+            raise
+        return self._validate_and_process_params(parsed_result)
+
+    def _parse_json_response(self, json_response: str) -> Dict[str, Any]:
+        """Parse JSON response into structured parameters"""
+        try:
+            parsed = orjson.loads(json_response)
+        except orjson.JSONDecodeError:
+            # Models sometimes wrap the object in a ```json fence or a
+            # sentence; decode the outermost {...} instead
+            start, end = json_response.find("{"), json_response.rfind("}")
+            if start == -1 or end < start:
+                raise
+            parsed = orjson.loads(json_response[start:end + 1])
+        
+        search_type = str(parsed.get("search_type", "search")).strip()
+        
+        # TMDB expects string query params, whatever type the model used
+        params = {
+            str(name).strip(): str(value).strip()
+            for name, value in parsed.get("params", {}).items()
+        }
         
         return {
             "search_type": search_type,
@@ -189,9 +212,9 @@ Return ONLY the XML, no other text or formatting."""
             genre_value = params["with_genres"]
             if isinstance(genre_value, str) and not genre_value.isdigit():
                 # Convert genre name to ID
-                genre_name = genre_value.lower()
-                if genre_name in self.genre_map:
-                    params["with_genres"] = str(self.genre_map[genre_name])
+                genre_id = self._genre_aliases.get(genre_value.strip().lower())
+                if genre_id is not None:
+                    params["with_genres"] = str(genre_id)
         
         return {
             "search_type": search_type,
@@ -215,14 +238,13 @@ Return ONLY the XML, no other text or formatting."""
                         "params": {"query": title}
                     }
         
-        # Genre detection (improved to catch more variations)
-        for genre_name, genre_id in self.genre_map.items():
-            if genre_name in query or f"{genre_name} movie" in query or f"{genre_name} film" in query:
-                params["with_genres"] = str(genre_id)
-                break
+        # Genre detection
+        genre_match = self._genre_re.search(query)
+        if genre_match:
+            params["with_genres"] = str(self._genre_aliases[genre_match.group(1)])
         
         # Year detection
-        year_match = re.search(r'\b(19|20)\d{2}\b', query)
+        year_match = _YEAR_RE.search(query)
         if year_match:
             params["primary_release_year"] = year_match.group()
         
@@ -0,0 +1,26 @@
+import asyncio
+import time
+
+class TokenBucket:
+    """Async token bucket allowing `rate` acquisitions per `per` seconds, with bursts up to `rate`"""
+    
+    def __init__(self, rate: int, per: float):
+        self._capacity = float(rate)
+        self._refill_per_second = rate / per
+        self._tokens = float(rate)
+        self._updated_at = time.monotonic()
+        # Waiters queue on the lock so tokens are handed out in arrival order
+        self._lock = asyncio.Lock()
+    
+    async def acquire(self) -> None:
+        """Wait until a token is available and take it"""
+        async with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self._capacity, self._tokens + (now - self._updated_at) * self._refill_per_second)
+            self._updated_at = now
+            if self._tokens < 1:
+                await asyncio.sleep((1 - self._tokens) / self._refill_per_second)
+                self._updated_at = time.monotonic()
+                self._tokens = 0.0
+            else:
+                self._tokens -= 1
@@ -0,0 +1,34 @@
+import httpx
+from tenacity import AsyncRetrying, RetryCallState, retry_if_exception, stop_after_attempt, wait_exponential, wait_random
+
+# Longest server-requested Retry-After we'll honour before giving up on the wait
+MAX_RETRY_AFTER = 5.0
+
+_backoff = wait_exponential(multiplier=0.1, max=1.0) + wait_random(0, 0.1)
+
+def is_transient_error(exc: BaseException) -> bool:
+    """Timeouts, rate limiting (429) and server errors (5xx) are worth retrying"""
+    if isinstance(exc, httpx.TimeoutException):
+        return True
+    if isinstance(exc, httpx.HTTPStatusError):
+        status = exc.response.status_code
+        return status == 429 or status >= 500
+    return False
+
+def wait_for_retry(retry_state: RetryCallState) -> float:
+    """Use the server's Retry-After (in seconds) when given, else jittered exponential backoff"""
+    exc = retry_state.outcome.exception() if retry_state.outcome else None
+    if isinstance(exc, httpx.HTTPStatusError):
+        retry_after = exc.response.headers.get("Retry-After", "")
+        if retry_after.isdigit():
+            return min(float(retry_after), MAX_RETRY_AFTER)
+    return _backoff(retry_state)
+
+def retrying() -> AsyncRetrying:
+    """Retry policy for outbound API calls: 3 attempts, honouring Retry-After"""
+    return AsyncRetrying(
+        stop=stop_after_attempt(3),
+        wait=wait_for_retry,
+        retry=retry_if_exception(is_transient_error),
+        reraise=True,
+    )
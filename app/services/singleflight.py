@@ -0,0 +1,61 @@
+import asyncio
+from cachetools import TTLCache
+from typing import Awaitable, Callable, Dict, Hashable, Optional, TypeVar
+
+T = TypeVar("T")
+
+class SingleFlightCache:
+    """TTL cache whose misses run at most once per key, sharing the result with concurrent callers"""
+    
+    def __init__(self, maxsize: int, ttl: float):
+        self._cache = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._inflight: Dict[Hashable, asyncio.Future] = {}
+    
+    async def get_or_run(
+        self,
+        key: Hashable,
+        run: Callable[[], Awaitable[T]],
+        cacheable: Optional[Callable[[T], bool]] = None,
+    ) -> T:
+        """
+        Return the cached value for key, or await run() once and cache its
+        result. A result is only stored when cacheable(result) is true
+        """
+        while True:
+            cached = self._cache.get(key)
+            if cached is not None:
+                return cached
+            
+            leader = self._inflight.get(key)
+            if leader is None:
+                break
+            
+            # An identical call is already running, wait for its outcome. The
+            # shield keeps a cancelled waiter from cancelling the shared future
+            try:
+                return await asyncio.shield(leader)
+            except asyncio.CancelledError:
+                # Only the leader was cancelled: look again, joining a newer
+                # call or running it ourselves
+                if not leader.cancelled() or asyncio.current_task().cancelling():
+                    raise
+        
+        future = asyncio.get_running_loop().create_future()
+        # Mark the outcome as retrieved even if no other caller was waiting on it
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        self._inflight[key] = future
+        try:
+            result = await run()
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        else:
+            if cacheable is None or cacheable(result):
+                self._cache[key] = result
+            future.set_result(result)
+            return result
+        finally:
+            del self._inflight[key]
+            # The leader was cancelled before finishing
+            if not future.done():
+                future.cancel()
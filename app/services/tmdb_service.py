@@ -1,175 +1,294 @@
+import asyncio
+import logging
+import math
+import time
 import httpx
-from typing import List, Dict, Any, Optional
+import orjson
+from cachetools import TLRUCache
+from typing import List, Dict, Any, Optional, Set, Tuple
+
+from app.services.rate_limit import TokenBucket
+from app.services.retry import retrying
+from app.services.singleflight import SingleFlightCache
+
+logger = logging.getLogger(__name__)
+
+MAX_CONCURRENT_REQUESTS = 8
+RATE_LIMIT_REQUESTS = 40
+RATE_LIMIT_PERIOD = 10.0
+TMDB_PAGE_SIZE = 20
+TMDB_MAX_PAGE = 500
+MAX_EXTRA_PAGES = 4
+PERSON_TTL = 7 * 86400
+PERSON_MISS_TTL = 3600
+_MISSING = object()
 
 class TMDBService:
-    def __init__(self, api_key: str):
+    def __init__(self, api_key: str, client: Optional[httpx.AsyncClient] = None):
         self.api_key = api_key
         self.base_url = "https://api.themoviedb.org/3"
         self.image_base_url = "https://image.tmdb.org/t/p"
+        self._poster_prefix = f"{self.image_base_url}/w500"
+        self._backdrop_prefix = f"{self.image_base_url}/w1280"
+        
+        # Genre list rarely changes: language -> (expires_at, mapping)
+        self._genre_cache: Dict[str, Tuple[float, Dict[int, str]]] = {}
+        self._genre_ttl = 86400
+        self._genre_lock = asyncio.Lock()
+        self._background_tasks: Set[asyncio.Future] = set()
+        
+        # Cap how many TMDB requests are open at once from this process
+        self._request_slots = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+        # and pace them to TMDB's per-IP rate limit, so bursts wait here
+        # instead of triggering 429s
+        self._rate_limit = TokenBucket(RATE_LIMIT_REQUESTS, RATE_LIMIT_PERIOD)
+        
+        # Person name -> ID; misses expire sooner in case TMDB adds the person
+        self._person_cache = TLRUCache(
+            maxsize=1024,
+            ttu=lambda _key, person_id, now: now + (PERSON_TTL if person_id is not None else PERSON_MISS_TTL),
+        )
+        
+        # Short-lived cache of decoded discover/search responses, keyed on
+        # (path, sorted params); identical requests in flight are shared
+        self._response_cache = SingleFlightCache(maxsize=512, ttl=300)
+        
+        # Use the caller's client when given (the app shares one); otherwise
+        # keep our own pooled client alive for the lifetime of the service
+        self._owns_client = client is None
+        self.client = client or httpx.AsyncClient(
+            timeout=30.0,
+            transport=httpx.AsyncHTTPTransport(
+                http2=True,
+                retries=2,
+                limits=httpx.Limits(max_connections=100, max_keepalive_connections=20),
+            ),
+        )
         
-    async def search_movies(self, search_params: Dict[str, Any], limit: int = 20) -> List[Dict[str, Any]]:
+    async def close(self) -> None:
+        """Close the HTTP client if this service created it"""
+        if self._owns_client:
+            await self.client.aclose()
+    
+    async def __aenter__(self) -> "TMDBService":
+        return self
+    
+    async def __aexit__(self, *exc_info) -> None:
+        await self.close()
+    
+    async def search_movies(self, search_params: Dict[str, Any], limit: int = 20) -> Tuple[List[Dict[str, Any]], bool]:
         """
         Search for movies using TMDB API with structured parameters
         search_params should contain 'search_type' and 'params' keys
+        Returns (movies, complete); complete is False when a person or genre
+        lookup failed and the movies were fetched or formatted without it
         """
         
-        headers = {
-            "Content-Type": "application/json"
-        }
-        
         search_type = search_params.get("search_type", "search")
         params = search_params.get("params", {})
         
-        # Add API key and common parameters
+        # /search/movie needs a title; use the structured filters with
+        # /discover/movie instead of sending a search that TMDB rejects
+        if search_type != "discover":
+            search_type = "search" if params.get("query") else "discover"
+        
+        # Adult filter can't be overridden by the translated params
         api_params = {
-            "api_key": self.api_key,
+            **params,
+            "page": self._valid_page(params.get("page")),
             "include_adult": "false",
-            "language": "en-US",
-            "page": "1",
-            **params
         }
         
-        async with httpx.AsyncClient(timeout=30.0) as client:
+        # Fetch genre mapping concurrently with the movie lookup
+        genre_task = asyncio.ensure_future(self._get_genre_mapping())
+        complete = True
+        try:
             # Choose endpoint based on search type
             if search_type == "discover":
-                movies = await self._discover_movies(client, headers, api_params, limit)
-            else:  # search_type == "search"
-                movies = await self._search_movies(client, headers, api_params, limit)
-            
-            return movies
-    
-    async def _discover_movies(self, client: httpx.AsyncClient, headers: Dict[str, str], 
-                             params: Dict[str, str], limit: int) -> List[Dict[str, Any]]:
-        """Use /discover/movie endpoint for filtered searches"""
-        
-        # Resolve person names to IDs if needed
-        if "with_cast" in params:
-            person_id = await self._get_person_id(client, headers, params["with_cast"])
-            if person_id:
-                params["with_cast"] = str(person_id)
-            else:
-                # Remove if person not found
-                del params["with_cast"]
+                complete = await self._resolve_people(api_params)
+                # Set default sorting if not specified
+                api_params.setdefault("sort_by", "popularity.desc")
+            movies = await self._fetch(search_type, api_params, limit)
+        except BaseException:
+            self._detach(genre_task)
+            raise
         
-        if "with_crew" in params:
-            person_id = await self._get_person_id(client, headers, params["with_crew"])
-            if person_id:
-                params["with_crew"] = str(person_id)
-            else:
-                del params["with_crew"]
-        
-        # Set default sorting if not specified
-        if "sort_by" not in params:
-            params["sort_by"] = "popularity.desc"
+        # Only wait on genres if a kept result has any; otherwise let the
+        # fetch finish in the background so it still warms the cache
+        if any(movie.get("genre_ids") for movie in movies):
+            genre_map = await genre_task
+            if genre_map is None:
+                complete = False
+                genre_map = {}
+        else:
+            self._detach(genre_task)
+            genre_map = {}
         
-        response = await client.get(
-            f"{self.base_url}/discover/movie",
-            headers=headers,
-            params=params
+        return self._format_movies(movies, genre_map), complete
+    
+    @staticmethod
+    def _valid_page(page: Any) -> str:
+        """Return page as a TMDB page number string, falling back to the first page"""
+        page = str(page or "").strip()
+        if page.isdigit() and 1 <= int(page) <= TMDB_MAX_PAGE:
+            return page
+        return "1"
+    
+    def _detach(self, task: "asyncio.Future") -> None:
+        """Keep a task we no longer await alive until it finishes"""
+        self._background_tasks.add(task)
+        task.add_done_callback(self._background_tasks.discard)
+    
+    async def _get_json(self, path: str, params: Dict[str, Any]) -> Dict[str, Any]:
+        """GET a TMDB path and decode the JSON body, retrying transient failures"""
+        # Parameters every TMDB call needs; the shared client also talks to
+        # OpenRouter, so the API key can't be bound on the client itself
+        params = {"language": "en-US", **params, "api_key": self.api_key}
+        async for attempt in retrying():
+            with attempt:
+                await self._rate_limit.acquire()
+                # Hold the slot only for the request itself, not the backoff
+                async with self._request_slots:
+                    response = await self.client.get(self.base_url + path, params=params)
+                response.raise_for_status()
+        return orjson.loads(response.content)
+    
+    async def _get_cached(self, path: str, params: Dict[str, Any]) -> Dict[str, Any]:
+        """GET a JSON payload, reusing a recent identical response or request in flight"""
+        key = (path, tuple(sorted(params.items())))
+        return await self._response_cache.get_or_run(key, lambda: self._get_json(path, params))
+    
+    async def warm_genre_cache(self) -> None:
+        """Prefetch the genre mapping so the first search doesn't pay for it"""
+        await self._get_genre_mapping()
+    
+    async def _resolve_people(self, params: Dict[str, str]) -> bool:
+        """
+        Replace with_cast/with_crew names with TMDB person IDs, in place
+        Returns False if a lookup failed and its filter had to be dropped
+        """
+        # Look up cast and crew concurrently
+        person_keys = [key for key in ("with_cast", "with_crew") if key in params]
+        person_ids = await asyncio.gather(
+            *[self._get_person_id(params[key]) for key in person_keys]
         )
-        response.raise_for_status()
-        
-        data = response.json()
-        movies = data.get("results", [])
         
-        return await self._format_movies(movies[:limit], client, headers)
+        complete = True
+        for key, person_id in zip(person_keys, person_ids):
+            if person_id is _MISSING:
+                complete = False
+                del params[key]
+            elif person_id:
+                params[key] = str(person_id)
+            else:
+                # Remove if person not found
+                del params[key]
+        return complete
     
-    async def _search_movies(self, client: httpx.AsyncClient, headers: Dict[str, str], 
-                           params: Dict[str, str], limit: int) -> List[Dict[str, Any]]:
-        """Use /search/movie endpoint for title searches"""
-        
-        response = await client.get(
-            f"{self.base_url}/search/movie",
-            headers=headers,
-            params=params
-        )
-        response.raise_for_status()
+    async def _fetch(self, search_type: str, params: Dict[str, str], limit: int) -> List[Dict[str, Any]]:
+        """Use /discover/movie for filtered searches or /search/movie for title searches"""
+        path = f"/{search_type}/movie"
+        data = await self._get_cached(path, params)
+        results = data.get("results", [])
         
-        data = response.json()
-        movies = data.get("results", [])
+        # A full page may have more after it; fetch the further pages needed
+        # to reach limit concurrently, within TMDB's page range
+        if len(results) == TMDB_PAGE_SIZE and len(results) < limit:
+            first_page = int(params["page"])
+            extra_pages = min(MAX_EXTRA_PAGES, math.ceil((limit - len(results)) / TMDB_PAGE_SIZE))
+            last_page = min(
+                data.get("total_pages", first_page),
+                first_page + extra_pages,
+                TMDB_MAX_PAGE,
+            )
+            pages = await asyncio.gather(*[
+                self._get_cached(path, {**params, "page": str(page)})
+                for page in range(first_page + 1, last_page + 1)
+            ])
+            # Build a new list; the first page's list lives in the response cache
+            results = results + [movie for page in pages for movie in page.get("results", [])]
         
-        return await self._format_movies(movies[:limit], client, headers)
+        return results[:limit]
     
-    async def _get_person_id(self, client: httpx.AsyncClient, headers: Dict[str, str], 
-                           person_name: str) -> Optional[int]:
-        """Get person ID from name using /search/person"""
+    async def _get_person_id(self, person_name: str) -> Any:
+        """
+        Get person ID from name using /search/person, cached per name
+        Returns None if TMDB has no such person, or _MISSING if the lookup failed
+        """
+        key = person_name.strip().lower()
+        cached = self._person_cache.get(key, _MISSING)
+        if cached is not _MISSING:
+            return cached
+        
         try:
-            response = await client.get(
-                f"{self.base_url}/search/person",
-                headers=headers,
-                params={
-                    "api_key": self.api_key,
-                    "query": person_name,
-                    "language": "en-US"
-                }
-            )
-            response.raise_for_status()
-            
-            data = response.json()
+            data = await self._get_json("/search/person", {"query": person_name})
             results = data.get("results", [])
             
-            if results:
-                # Return the first (most popular) match
-                return results[0].get("id")
+            # Take the first (most popular) match; None is cached too, briefly
+            person_id = results[0].get("id") if results else None
+            self._person_cache[key] = person_id
+            return person_id
             
-        except Exception as e:
-            print(f"Error looking up person '{person_name}': {e}")
+        except (httpx.HTTPError, orjson.JSONDecodeError, KeyError) as e:
+            logger.warning("Person lookup failed for %r: %s", person_name, e)
         
-        return None
+        return _MISSING
     
-    async def _format_movies(self, movies: List[Dict[str, Any]], client: httpx.AsyncClient, 
-                           headers: Dict[str, str]) -> List[Dict[str, Any]]:
+    def _format_movies(self, movies: List[Dict[str, Any]], genre_map: Dict[int, str]) -> List[Dict[str, Any]]:
         """Format movie data for frontend consumption"""
-        
-        # Get genre mapping for better display
-        genre_map = await self._get_genre_mapping(client, headers)
-        
-        formatted_movies = []
-        for movie in movies:
-            formatted_movie = await self._format_movie(movie, genre_map)
-            formatted_movies.append(formatted_movie)
-        
-        return formatted_movies
+        return [self._format_movie(movie, genre_map) for movie in movies]
     
-    async def _get_genre_mapping(self, client: httpx.AsyncClient, headers: Dict[str, str]) -> Dict[int, str]:
-        """Get genre ID to name mapping"""
-        try:
-            response = await client.get(
-                f"{self.base_url}/genre/movie/list",
-                headers=headers,
-                params={"api_key": self.api_key, "language": "en-US"}
-            )
-            response.raise_for_status()
+    async def _get_genre_mapping(self, language: str = "en-US") -> Optional[Dict[int, str]]:
+        """Get genre ID to name mapping, cached for _genre_ttl seconds; None if unavailable"""
+        cached = self._genre_cache.get(language)
+        if cached and time.monotonic() < cached[0]:
+            return cached[1]
+        
+        async with self._genre_lock:
+            # Another request may have refreshed the cache while we waited
+            cached = self._genre_cache.get(language)
+            if cached and time.monotonic() < cached[0]:
+                return cached[1]
             
-            data = response.json()
-            genres = data.get("genres", [])
+            try:
+                data = await self._get_json("/genre/movie/list", {"language": language})
+                genres = data.get("genres", [])
+                
+                genre_map = {genre["id"]: genre["name"] for genre in genres}
+            except (httpx.HTTPError, orjson.JSONDecodeError, KeyError):
+                # Don't cache failures; fall back to stale data if we have it
+                return cached[1] if cached else None
             
-            return {genre["id"]: genre["name"] for genre in genres}
-        except Exception:
-            return {}
+            self._genre_cache[language] = (time.monotonic() + self._genre_ttl, genre_map)
+            return genre_map
     
-    async def _format_movie(self, movie: Dict[str, Any], genre_map: Dict[int, str]) -> Dict[str, Any]:
+    def _format_movie(self, movie: Dict[str, Any], genre_map: Dict[int, str]) -> Dict[str, Any]:
         """Format movie data for frontend consumption"""
         
+        get = movie.get
+        poster_path = get("poster_path")
+        backdrop_path = get("backdrop_path")
+        
         # Map genre IDs to names
-        genre_ids = movie.get("genre_ids", [])
-        genre_names = [genre_map.get(genre_id, "") for genre_id in genre_ids if genre_id in genre_map]
+        genre_ids = get("genre_ids", [])
+        genre_name = genre_map.get
+        genre_names = [name for genre_id in genre_ids if (name := genre_name(genre_id))]
         
         return {
-            "id": movie.get("id"),
-            "title": movie.get("title", "Unknown Title"),
-            "original_title": movie.get("original_title"),
-            "overview": movie.get("overview", ""),
-            "release_date": movie.get("release_date", ""),
-            "vote_average": round(movie.get("vote_average", 0), 1),
-            "vote_count": movie.get("vote_count", 0),
-            "popularity": movie.get("popularity", 0),
-            "poster_path": movie.get("poster_path"),
-            "backdrop_path": movie.get("backdrop_path"),
+            "id": get("id"),
+            "title": get("title", "Unknown Title"),
+            "original_title": get("original_title"),
+            "overview": get("overview", ""),
+            "release_date": get("release_date", ""),
+            "vote_average": round(get("vote_average", 0), 1),
+            "vote_count": get("vote_count", 0),
+            "popularity": get("popularity", 0),
+            "poster_path": poster_path,
+            "backdrop_path": backdrop_path,
             "genre_ids": genre_ids,
             "genre_names": genre_names,
-            "adult": movie.get("adult", False),
-            "original_language": movie.get("original_language", ""),
-            "poster_url": f"{self.image_base_url}/w500{movie.get('poster_path')}" if movie.get("poster_path") else None,
-            "backdrop_url": f"{self.image_base_url}/w1280{movie.get('backdrop_path')}" if movie.get("backdrop_path") else None,
+            "adult": get("adult", False),
+            "original_language": get("original_language", ""),
+            "poster_url": self._poster_prefix + poster_path if poster_path else None,
+            "backdrop_url": self._backdrop_prefix + backdrop_path if backdrop_path else None,
         } 
\ No newline at end of file